@@ -1,10 +1,14 @@
-from sqlalchemy import create_engine
+import os
+from sqlalchemy import create_engine, event
 from sqlalchemy.orm import sessionmaker
 from sqlalchemy.ext.declarative import declarative_base
 
 # Define the database URL for SQLite
 SQLALCHEMY_DATABASE_URL = 'sqlite:///./clinicconnect.db'
 
+# Optional read replica used by the read-only routes
+SQLALCHEMY_READ_DATABASE_URL = os.getenv('SQLALCHEMY_READ_DATABASE_URL')
+
 # Create an engine instance with the database URL
 engine = create_engine(SQLALCHEMY_DATABASE_URL, connect_args={'check_same_thread': False})
 
@@ -13,3 +17,45 @@ SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 
 # Create a Base class that our models will inherit
 Base = declarative_base()
+
+
+# Create the engine for read-only queries: the replica when one is configured,
+# otherwise a separate pool of read-only SQLite connections to the same file
+def create_read_engine():
+    if SQLALCHEMY_READ_DATABASE_URL:
+        return create_engine(SQLALCHEMY_READ_DATABASE_URL)
+    if engine.dialect.name == 'sqlite':
+        path = SQLALCHEMY_DATABASE_URL[len('sqlite:///'):]
+        return create_engine(
+            f'sqlite:///file:{path}?mode=ro&uri=true',
+            connect_args={'check_same_thread': False},
+        )
+    return engine
+
+read_engine = create_read_engine()
+
+
+# WAL lets the SQLite readers keep reading while a writer holds the lock
+@event.listens_for(engine, 'connect')
+def set_sqlite_pragma(dbapi_connection, connection_record):
+    if engine.dialect.name == 'sqlite':
+        cursor = dbapi_connection.cursor()
+        cursor.execute('PRAGMA journal_mode=WAL')
+        cursor.close()
+
+
+# Dependency to get the database session, shared by every router so the
+# session is created once per request
+def get_db():
+    db = SessionLocal()
+    try:
+        yield db
+    finally:
+        db.close()
+
+
+# Dependency to get a read-only connection for routes that only run selects,
+# skipping the session's unit of work and identity map entirely
+def get_read_db():
+    with read_engine.connect() as connection:
+        yield connection
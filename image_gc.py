@@ -0,0 +1,136 @@
+import argparse
+import asyncio
+import logging
+import os
+import time
+
+from database import SessionLocal
+from models import ClinicPictures, ProfilePictures, LegalInformation
+from storage import storage, CLINIC_PICTURES, PROFILE_PICTURES, USERS_IDS
+
+logger = logging.getLogger(__name__)
+
+# Map every image category to the column that references its files and the
+# owner of the referencing row. Rows whose owner was deleted before picture rows
+# were cascaded are left with a NULL owner and don't keep their file alive.
+IMAGE_CATEGORIES = {
+    CLINIC_PICTURES: (ClinicPictures.image_url, ClinicPictures.clinic_id),
+    PROFILE_PICTURES: (ProfilePictures.image_url, ProfilePictures.user_id),
+    USERS_IDS: (LegalInformation.syndicate_id_url, LegalInformation.owner),
+}
+
+# Files younger than this are never collected, so an upload that has been
+# written to disk but not committed to the database yet is left alone
+DEFAULT_GRACE_PERIOD_SECONDS = 60 * 60
+DEFAULT_BATCH_SIZE = 500
+
+# Interval of the optional in-process collector, disabled when 0
+IMAGE_GC_INTERVAL_SECONDS = int(os.getenv("IMAGE_GC_INTERVAL_SECONDS", "0"))
+
+
+def _iter_candidate_files(category: str, grace_period: float):
+    cutoff = time.time() - grace_period
+    for key, size, mtime in storage.list_images(category):
+        if mtime > cutoff:
+            continue
+        yield key, size
+
+
+def _batched(iterable, size: int):
+    batch = []
+    for item in iterable:
+        batch.append(item)
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def collect_orphaned_images(
+    grace_period: float = DEFAULT_GRACE_PERIOD_SECONDS,
+    batch_size: int = DEFAULT_BATCH_SIZE,
+    dry_run: bool = False,
+):
+    """Delete image files that no database row references.
+
+    Each category of the storage backend is scanned in batches; every batch is
+    checked against the database with a single ``IN`` query and the difference
+    of the two sets is removed. Rows left without an owner are deleted first.
+    Returns a report with the number of files and bytes reclaimed.
+    """
+    report = {"dry_run": dry_run, "files": 0, "bytes": 0, "categories": {}}
+
+    db = SessionLocal()
+    try:
+        for category, (column, owner) in IMAGE_CATEGORIES.items():
+            stats = {"scanned": 0, "files": 0, "bytes": 0, "compacted_bytes": 0, "ownerless_rows": 0}
+            report["categories"][category] = stats
+
+            ownerless = db.query(column.class_).filter(owner.is_(None))
+            if dry_run:
+                stats["ownerless_rows"] = ownerless.count()
+            else:
+                stats["ownerless_rows"] = ownerless.delete(synchronize_session=False)
+                db.commit()
+
+            for batch in _batched(_iter_candidate_files(category, grace_period), batch_size):
+                sizes = dict(batch)
+                stats["scanned"] += len(sizes)
+
+                referenced = {
+                    name for (name,) in db.query(column).filter(column.in_(list(sizes)), owner.isnot(None)).all()
+                }
+                orphans = sizes.keys() - referenced
+
+                for name in orphans:
+                    if not dry_run and not storage.delete(category, name):
+                        continue
+                    stats["files"] += 1
+                    stats["bytes"] += sizes[name]
+
+            # Packed segments only give deleted blobs back once rewritten. The backend
+            # decides from its dead bytes, which include images deleted by the API.
+            if not dry_run:
+                stats["compacted_bytes"] = storage.compact(category)
+
+            report["files"] += stats["files"]
+            report["bytes"] += stats["bytes"]
+    finally:
+        db.close()
+
+    return report
+
+
+async def run_periodic_image_gc(interval: float = IMAGE_GC_INTERVAL_SECONDS):
+    # Run the collector in a worker thread so disk and database I/O never block the event loop
+    loop = asyncio.get_running_loop()
+    while True:
+        await asyncio.sleep(interval)
+        # A failed run (e.g. the database being locked) must not stop later runs
+        try:
+            await loop.run_in_executor(None, collect_orphaned_images)
+        except Exception:
+            logger.exception("Orphaned image collection failed")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Delete image files that are no longer referenced by the database.")
+    parser.add_argument("--grace-period", type=float, default=DEFAULT_GRACE_PERIOD_SECONDS,
+                        help="skip files modified less than this many seconds ago")
+    parser.add_argument("--batch-size", type=int, default=DEFAULT_BATCH_SIZE,
+                        help="number of files checked against the database per query")
+    parser.add_argument("--dry-run", action="store_true", help="report orphaned files without deleting them")
+    args = parser.parse_args()
+
+    report = collect_orphaned_images(args.grace_period, args.batch_size, args.dry_run)
+
+    action = "Would reclaim" if args.dry_run else "Reclaimed"
+    for category, stats in report["categories"].items():
+        print(f"{category}: scanned {stats['scanned']}, orphaned {stats['files']} ({stats['bytes']} bytes), "
+              f"compacted {stats['compacted_bytes']} bytes, ownerless rows {stats['ownerless_rows']}")
+    print(f"{action} {report['bytes']} bytes from {report['files']} files")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,13 +1,65 @@
+import asyncio
+from contextlib import asynccontextmanager
 from fastapi import FastAPI
+from sqlalchemy import inspect, text
+from sqlalchemy.exc import IntegrityError, OperationalError
 from routers import auth, users, admin, clinics, pictures
-from database import engine, Base
+from database import engine, Base, SessionLocal
+from models import Clinics, SyncCounters
+from image_gc import IMAGE_GC_INTERVAL_SECONDS, run_periodic_image_gc
+from profiling import ProfilingMiddleware
+
+
+# Start the optional background jobs for the lifetime of the application
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    image_gc_task = None
+    if IMAGE_GC_INTERVAL_SECONDS > 0:
+        image_gc_task = asyncio.create_task(run_periodic_image_gc())
+    yield
+    if image_gc_task is not None:
+        image_gc_task.cancel()
+
 
 # Create an instance of FastAPI
-app = FastAPI()
+app = FastAPI(lifespan=lifespan)
+
+# Profile requests on demand, see the /admin/profiles routes
+app.add_middleware(ProfilingMiddleware)
 
 # Ensure all tables are created
 Base.metadata.create_all(bind=engine)
 
+# create_all never alters existing tables, so add the change feed columns to
+# databases created before it
+clinic_columns = {column["name"] for column in inspect(engine).get_columns("clinics")}
+for name, column_type in (("version", "INTEGER"), ("updated_at", "VARCHAR")):
+    if name not in clinic_columns:
+        try:
+            with engine.begin() as connection:
+                connection.execute(text(f"ALTER TABLE clinics ADD COLUMN {name} {column_type}"))
+        except OperationalError:
+            # Another worker added it first
+            pass
+with engine.begin() as connection:
+    connection.execute(text("CREATE INDEX IF NOT EXISTS ix_clinics_version ON clinics (version)"))
+
+# Ensure the clinic version counter exists before any request bumps it
+with SessionLocal() as db:
+    if db.get(SyncCounters, "clinics") is None:
+        db.add(SyncCounters(name="clinics", value=0))
+        try:
+            db.commit()
+        except IntegrityError:
+            # Another worker created it first
+            db.rollback()
+
+    # Give clinics created before the change feed a version so a sync from 0 sees them
+    unversioned = db.query(Clinics).filter(Clinics.version.is_(None)).all()
+    for clinic_model in unversioned:
+        clinics.bump_clinic_version(db, clinic_model)
+    db.commit()
+
 # Include the authentication router
 app.include_router(auth.router)
 
@@ -21,4 +73,4 @@ app.include_router(admin.router)
 app.include_router(clinics.router)
 
 #Include the picture's router
-app.include_router(pictures.router)
\ No newline at end of file
+app.include_router(pictures.router)
@@ -10,7 +10,7 @@ class Users(Base):
     id = Column(Integer, primary_key=True, index=True)
     full_name = Column(String)
     gender = Column(String)
-    profile_picture = relationship("ProfilePictures", back_populates="user")  # Field to store the profile picture URL or path
+    profile_picture = relationship("ProfilePictures", back_populates="user", cascade="all, delete-orphan")  # Field to store the profile picture URL or path
     hashed_password = Column(String)
     email = Column(String, unique=True)
     mobile_number = Column(String, unique=True)
@@ -22,7 +22,7 @@ class Users(Base):
     # Establish a relationship with the Clinics model
     clinics = relationship("Clinics", back_populates="owner")
 
-    syndicate_id = relationship("LegalInformation", back_populates="user_id")
+    syndicate_id = relationship("LegalInformation", back_populates="user_id", cascade="all, delete-orphan")
 
 
 
@@ -61,7 +61,11 @@ class Clinics(Base):
     staff_type = Column(String)
 
     # Clinic pictures (one-to-many relationship)
-    pictures = relationship("ClinicPictures", back_populates="clinic")
+    pictures = relationship("ClinicPictures", back_populates="clinic", cascade="all, delete-orphan")
+
+    # Change tracking, bumped whenever the clinic or its pictures change
+    version = Column(Integer, index=True)
+    updated_at = Column(String)
 
 
 
@@ -69,12 +73,29 @@ class ClinicPictures(Base):
     __tablename__ = 'clinic_pictures'
 
     id = Column(Integer, primary_key=True, index=True)
-    owner_clinic_id = Column(Integer, ForeignKey('clinics.id'))
+    clinic_id = Column('owner_clinic_id', Integer, ForeignKey('clinics.id'))
     image_url = Column(String)  # Or use Base64-encoded string if storing the image data directly
 
     clinic = relationship("Clinics", back_populates="pictures")
 
 
+# Records deleted clinics so clients syncing through the change feed can drop them
+class ClinicTombstones(Base):
+    __tablename__ = "clinic_tombstones"
+
+    clinic_id = Column(Integer, primary_key=True)
+    version = Column(Integer, index=True)
+    deleted_at = Column(String)
+
+
+# Named monotonically increasing counters, used to version clinic changes
+class SyncCounters(Base):
+    __tablename__ = "sync_counters"
+
+    name = Column(String, primary_key=True)
+    value = Column(Integer, default=0)
+
+
 class ProfilePictures(Base):
     __tablename__ = "profile_pictures"
 
@@ -0,0 +1,216 @@
+import asyncio
+import json
+import os
+import random
+import sys
+import threading
+import time
+import uuid
+from contextvars import ContextVar
+from datetime import datetime, timedelta, timezone
+
+from jose import jwt, JWTError
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+from routers.auth import SECRET_KEY, ALGORITHM
+
+# Fraction of requests profiled without being asked to, disabled when 0
+PROFILE_SAMPLE_RATE = float(os.getenv("PROFILE_SAMPLE_RATE", "0"))
+# Where reports are kept and how many of them, oldest reports are dropped first
+PROFILE_DIRECTORY = os.getenv("PROFILE_DIRECTORY", "profiles")
+PROFILE_MAX_REPORTS = max(1, int(os.getenv("PROFILE_MAX_REPORTS", "50")))
+# Seconds between two stack samples
+PROFILE_INTERVAL = float(os.getenv("PROFILE_INTERVAL", "0.005"))
+
+# Header carrying a token from /admin/profiles/token to profile a single request
+PROFILE_HEADER = b"x-profile-token"
+PROFILE_TOKEN_PURPOSE = "profile"
+
+_current_profile = ContextVar("current_profile", default=None)
+
+
+# Create a signed token that opts requests into profiling until it expires
+def create_profile_token(email: str, expires_delta: timedelta):
+    expires = datetime.now(timezone.utc) + expires_delta
+    return jwt.encode({'sub': email, 'purpose': PROFILE_TOKEN_PURPOSE, 'exp': expires}, SECRET_KEY, algorithm=ALGORITHM)
+
+
+def _is_valid_profile_token(token: str):
+    try:
+        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
+    except JWTError:
+        return False
+    return payload.get('purpose') == PROFILE_TOKEN_PURPOSE
+
+
+class _StackSampler(threading.Thread):
+    """Samples the stack of one thread at a fixed interval.
+
+    Stacks are counted in the folded format understood by flamegraph.pl and
+    speedscope: frames joined with ``;`` from the outermost call inwards.
+    """
+
+    def __init__(self, thread_id: int, interval: float):
+        super().__init__(daemon=True)
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks = {}
+        self.stopped = threading.Event()
+
+    def _sample(self):
+        frame = sys._current_frames().get(self.thread_id)
+        frames = []
+        while frame is not None:
+            code = frame.f_code
+            frames.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})")
+            frame = frame.f_back
+        if frames:
+            stack = ";".join(reversed(frames))
+            self.stacks[stack] = self.stacks.get(stack, 0) + 1
+
+    def run(self):
+        # Sample right away so requests shorter than the interval still get a stack
+        self._sample()
+        while not self.stopped.wait(self.interval):
+            self._sample()
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+
+
+class _RequestProfile:
+    def __init__(self):
+        self.sql = {}
+
+
+# Time every statement run while a profiled request is active, on every engine
+@event.listens_for(Engine, "before_cursor_execute")
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if _current_profile.get() is not None:
+        conn.info.setdefault("profile_query_start", []).append(time.perf_counter())
+
+
+@event.listens_for(Engine, "after_cursor_execute")
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    profile = _current_profile.get()
+    if profile is None or not conn.info.get("profile_query_start"):
+        return
+    elapsed = time.perf_counter() - conn.info["profile_query_start"].pop()
+    count, total = profile.sql.get(statement, (0, 0.0))
+    profile.sql[statement] = (count + 1, total + elapsed)
+
+
+def _report_path(profile_id: str):
+    return os.path.join(PROFILE_DIRECTORY, f"{profile_id}.json")
+
+
+def _save_report(report: dict):
+    os.makedirs(PROFILE_DIRECTORY, exist_ok=True)
+    with open(_report_path(report["id"]), "w") as f:
+        json.dump(report, f)
+
+    # Ids start with a timestamp, so sorting them puts the oldest reports first
+    reports = sorted(name for name in os.listdir(PROFILE_DIRECTORY) if name.endswith(".json"))
+    for name in reports[:-PROFILE_MAX_REPORTS]:
+        try:
+            os.remove(os.path.join(PROFILE_DIRECTORY, name))
+        except FileNotFoundError:
+            pass
+
+
+def list_profiles():
+    """Return the summary of every stored report, newest first."""
+    if not os.path.isdir(PROFILE_DIRECTORY):
+        return []
+    summaries = []
+    for name in sorted(os.listdir(PROFILE_DIRECTORY), reverse=True):
+        report = load_profile(name[:-len(".json")]) if name.endswith(".json") else None
+        if report is None:
+            continue
+        summaries.append({key: value for key, value in report.items() if key not in ("stacks", "sql")})
+    return summaries
+
+
+def load_profile(profile_id: str):
+    """Return a stored report, or None when it doesn't exist."""
+    if not profile_id or os.path.basename(profile_id) != profile_id:
+        return None
+    try:
+        with open(_report_path(profile_id)) as f:
+            return json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return None
+
+
+def folded_stacks(report: dict):
+    """Render a report's samples in the folded format used by flame graph tools."""
+    return "".join(f"{stack} {count}\n" for stack, count in report["stacks"].items())
+
+
+class ProfilingMiddleware:
+    """Profile requests that carry a valid profile token or fall in the sample rate.
+
+    Everything else goes straight through after a header lookup, so requests
+    that aren't profiled pay next to nothing.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    def _should_profile(self, scope):
+        if PROFILE_SAMPLE_RATE > 0 and random.random() < PROFILE_SAMPLE_RATE:
+            return True
+        for name, value in scope["headers"]:
+            if name == PROFILE_HEADER:
+                return _is_valid_profile_token(value.decode("latin-1"))
+        return False
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not self._should_profile(scope):
+            await self.app(scope, receive, send)
+            return
+
+        response_status = {}
+
+        async def send_wrapper(message):
+            if message["type"] == "http.response.start":
+                response_status["code"] = message["status"]
+            await send(message)
+
+        profile = _RequestProfile()
+        token = _current_profile.set(profile)
+        # Async handlers run on the event loop thread, which is this thread; other
+        # requests interleaved on the loop can show up in the samples as well
+        sampler = _StackSampler(threading.get_ident(), PROFILE_INTERVAL)
+        started_at = datetime.now(timezone.utc)
+        start = time.perf_counter()
+        sampler.start()
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            duration = time.perf_counter() - start
+            sampler.stop()
+            _current_profile.reset(token)
+
+            route = scope.get("route")
+            statements = sorted(profile.sql.items(), key=lambda item: item[1][1], reverse=True)
+            report = {
+                "id": f"{time.time_ns()}-{uuid.uuid4().hex[:8]}",
+                "started_at": started_at.isoformat(),
+                "method": scope["method"],
+                "path": scope["path"],
+                "route": route.path if route is not None else scope["path"],
+                "status_code": response_status.get("code"),
+                "duration_ms": round(duration * 1000, 3),
+                "samples": sum(sampler.stacks.values()),
+                "sql_count": sum(count for count, _ in profile.sql.values()),
+                "sql_ms": round(sum(total for _, total in profile.sql.values()) * 1000, 3),
+                "sql": [
+                    {"statement": statement, "count": count, "total_ms": round(total * 1000, 3)}
+                    for statement, (count, total) in statements
+                ],
+                "stacks": sampler.stacks,
+            }
+            await asyncio.get_running_loop().run_in_executor(None, _save_report, report)
@@ -1,29 +1,71 @@
+from datetime import timedelta
 from typing import Annotated
-from database import SessionLocal
+from database import get_read_db
 from models import Users
 from fastapi import APIRouter, status, HTTPException, Depends
-from sqlalchemy.orm import Session
+from fastapi.responses import PlainTextResponse
+from sqlalchemy import Connection, select
 
 from routers.auth import get_current_user
+from profiling import create_profile_token, list_profiles, load_profile, folded_stacks
 
 
 router = APIRouter(prefix="/admin", tags=['admin'])
 
-def get_db():
-    db = SessionLocal()
-    try:
-        yield db
-    finally:
-        db.close()
-
-db_dependency = Annotated[Session, Depends(get_db)]
+read_db_dependency = Annotated[Connection, Depends(get_read_db)]
 user_dependency = Annotated[dict, Depends(get_current_user)]
 
 @router.get("/get_all_users", status_code=status.HTTP_200_OK)
-async def get_all_users(user: user_dependency, db: db_dependency):
+async def get_all_users(user: user_dependency, db: read_db_dependency):
+    if not user.get('user_role') == 'admin':
+        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Not Authorized")
+
+    all_users = [dict(row) for row in db.execute(select(Users.__table__)).mappings()]
+
+    return all_users
+
+
+@router.post("/profiles/token", status_code=status.HTTP_200_OK)
+async def get_profile_token(user: user_dependency):
+    if not user.get('user_role') == 'admin':
+        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Not Authorized")
+
+    # Requests sent with this header are profiled for the next 10 minutes
+    token = create_profile_token(user.get('email'), timedelta(minutes=10))
+
+    return {"header": "X-Profile-Token", "token": token}
+
+
+@router.get("/profiles", status_code=status.HTTP_200_OK)
+async def get_profiles(user: user_dependency):
+    if not user.get('user_role') == 'admin':
+        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Not Authorized")
+
+    return list_profiles()
+
+
+@router.get("/profiles/{profile_id}", status_code=status.HTTP_200_OK)
+async def get_profile(user: user_dependency, profile_id: str):
+    if not user.get('user_role') == 'admin':
+        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Not Authorized")
+
+    report = load_profile(profile_id)
+    if report is None:
+        raise HTTPException(status_code=404, detail="Profile not found")
+
+    return report
+
+
+@router.get("/profiles/{profile_id}/flamegraph", response_class=PlainTextResponse, status_code=status.HTTP_200_OK)
+async def get_profile_flamegraph(user: user_dependency, profile_id: str):
     if not user.get('user_role') == 'admin':
         raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Not Authorized")
 
-    all_users = db.query(Users).all()
+    report = load_profile(profile_id)
+    if report is None:
+        raise HTTPException(status_code=404, detail="Profile not found")
 
-    return all_users
\ No newline at end of file
+    return PlainTextResponse(
+        folded_stacks(report),
+        headers={"Content-Disposition": f'attachment; filename="{profile_id}.folded"'}
+    )
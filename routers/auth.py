@@ -1,11 +1,13 @@
 import base64
 import os
+import threading
+import time
 from datetime import datetime, timedelta, timezone
 from typing import Annotated
 from fastapi import APIRouter, Depends, Form, HTTPException, File, UploadFile
 from pydantic import BaseModel
-from sqlalchemy.orm import Session
-from database import SessionLocal
+from sqlalchemy.orm import Session, joinedload
+from database import get_db
 from models import Users, ProfilePictures
 from passlib.context import CryptContext
 from starlette import status
@@ -26,13 +28,10 @@ ALGORITHM = 'HS256'
 bcrypt_context = CryptContext(schemes=['bcrypt'], deprecated='auto')
 oauth2_bearer = OAuth2PasswordBearer(tokenUrl='auth/token')
 
-# Dependency to get the database session
-def get_db():
-    db = SessionLocal()
-    try:
-        yield db
-    finally:
-        db.close()
+# Per-process cache of loaded users, disabled when the TTL is 0
+USER_CACHE_TTL_SECONDS = float(os.getenv("USER_CACHE_TTL_SECONDS", "0"))
+_user_cache = {}
+_user_cache_lock = threading.Lock()
 
 db_dependency = Annotated[Session, Depends(get_db)]
 
@@ -65,6 +64,44 @@ async def get_current_user(token: Annotated[str, Depends(oauth2_bearer)]):
     except JWTError:
         raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Could not validate credentials")
 
+# Drop a user from the cache, to be called whenever the user or their profile picture changes
+def invalidate_cached_user(user_id: int):
+    with _user_cache_lock:
+        _user_cache.pop(user_id, None)
+
+def _get_cached_user(user_id: int):
+    with _user_cache_lock:
+        entry = _user_cache.get(user_id)
+        if entry is None:
+            return None
+        expires, user_model = entry
+        if expires < time.monotonic():
+            del _user_cache[user_id]
+            return None
+        return user_model
+
+# Dependency to load the current user's row, with the profile picture, once per request
+async def get_current_user_model(user: Annotated[dict, Depends(get_current_user)], db: db_dependency):
+    user_id = user.get('id')
+
+    cached_user = _get_cached_user(user_id) if USER_CACHE_TTL_SECONDS > 0 else None
+    if cached_user is not None:
+        # Attach a copy of the cached user to this request's session without querying
+        return db.merge(cached_user, load=False)
+
+    user_model = db.query(Users).options(joinedload(Users.profile_picture)).filter(Users.id == user_id).first()
+    if user_model is None:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="User not found")
+
+    if USER_CACHE_TTL_SECONDS > 0:
+        # Keep a detached instance in the cache so later commits can't expire it
+        db.expunge(user_model)
+        with _user_cache_lock:
+            _user_cache[user_id] = (time.monotonic() + USER_CACHE_TTL_SECONDS, user_model)
+        user_model = db.merge(user_model, load=False)
+
+    return user_model
+
 # Pydantic model for user creation request
 class CreateUserRequest(BaseModel):
     full_name: str
@@ -1,23 +1,19 @@
 import base64
-from fastapi import APIRouter, Depends, Form, Path, status, HTTPException, UploadFile, File
+from fastapi import APIRouter, Depends, Form, Path, Query, status, HTTPException, UploadFile, File
+from sqlalchemy import Connection, false, select, true, union_all, update
 from sqlalchemy.orm import Session
 from pydantic import BaseModel
 from datetime import datetime
 from typing import Annotated
 
-from database import SessionLocal
-from routers.auth import get_current_user
-from models import Clinics, ClinicPictures
-
-def get_db():
-    db = SessionLocal()
-    try:
-        yield db
-    finally:
-        db.close()
+from database import get_db, get_read_db
+from routers.auth import get_current_user, get_current_user_model
+from models import Clinics, ClinicPictures, ClinicTombstones, SyncCounters, Users
 
 db_dependency = Annotated[Session, Depends(get_db)]
+read_db_dependency = Annotated[Connection, Depends(get_read_db)]
 user_dependency = Annotated[dict, Depends(get_current_user)]
+current_user_dependency = Annotated[Users, Depends(get_current_user_model)]
 
 class ClinicRequest(BaseModel):
     title: str
@@ -55,17 +51,40 @@ class ClinicRequest(BaseModel):
 
 router = APIRouter(prefix="/clinics", tags=['clinics'])
 
+# Largest page the change feed returns
+MAX_CHANGES_PAGE_SIZE = 500
+
+
+# Allocate the next clinic version. The counter row is created at startup and
+# stays locked until the transaction commits, so versions become visible to
+# readers in order.
+def next_clinic_version(db: Session):
+    db.execute(
+        update(SyncCounters).where(SyncCounters.name == "clinics").values(value=SyncCounters.value + 1)
+    )
+    return db.execute(select(SyncCounters.value).where(SyncCounters.name == "clinics")).scalar_one()
+
+# Stamp a clinic as changed so it shows up in the change feed
+def bump_clinic_version(db: Session, clinic_model: Clinics):
+    clinic_model.version = next_clinic_version(db)
+    clinic_model.updated_at = str(datetime.now())
+    db.add(clinic_model)
+
 @router.get("/all_clinic_info", status_code=status.HTTP_200_OK)
-async def get_clinic_info(db: db_dependency, user: user_dependency):
+async def get_clinic_info(db: read_db_dependency, user: user_dependency):
     if user is None:
         raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="User Unauthorized")
     
     clinic_details = {}
-    
-    clinic_models = db.query(Clinics).all()
-    for n, clinic in enumerate(clinic_models, start=1):
-        clinic_urls = [f"http://127.0.0.1:8000/picture/clinic_images/{image.image_url}" for image in db.query(ClinicPictures).filter(ClinicPictures.clinic_id == clinic.id).all()]
-        clinic_details[f"clinic_{n}"] = {"clinic": clinic, "images": clinic_urls}
+
+    # Fetch every picture in one query and group them by clinic
+    clinic_urls = {}
+    for clinic_id, image_url in db.execute(select(ClinicPictures.clinic_id, ClinicPictures.image_url)):
+        clinic_urls.setdefault(clinic_id, []).append(f"http://127.0.0.1:8000/picture/clinic_images/{image_url}")
+
+    clinic_rows = db.execute(select(Clinics.__table__)).mappings()
+    for n, clinic in enumerate(clinic_rows, start=1):
+        clinic_details[f"clinic_{n}"] = {"clinic": dict(clinic), "images": clinic_urls.get(clinic["id"], [])}
     
     return clinic_details
 
@@ -74,7 +93,7 @@ async def get_clinic_info(db: db_dependency, user: user_dependency):
 @router.post("/add_clinic", status_code=status.HTTP_200_OK)
 async def add_clinic(
     db: db_dependency,
-    user: user_dependency,
+    user_model: current_user_dependency,
     clinic_request: ClinicRequest):
 
     # Create a new clinic entry
@@ -91,31 +110,30 @@ async def add_clinic(
         clinic_speciality=clinic_request.clinic_speciality,
         clinic_sub_speciality=clinic_request.clinic_sub_speciality,
         staff_type=clinic_request.staff_type,
-        owner_id=user.get("id"),
-        owner_name=user.get("full_name"),
+        owner_id=user_model.id,
+        owner_name=user_model.full_name,
         registration_date=str(datetime.now())
     )
-    db.add(clinic_model)
-    db.commit()
-    db.refresh(clinic_model)
-    
-    
-    
+    bump_clinic_version(db, clinic_model)
+    db.flush()
+
+    # A reused id must not stay marked as deleted
+    db.query(ClinicTombstones).filter(ClinicTombstones.clinic_id == clinic_model.id).delete()
     db.commit()
     return {"message": "Clinic created succesfully"}
 
 
 @router.get("/get_clinic_by_id/{clinic_id}", status_code=status.HTTP_200_OK)
-async def get_clinic_by_id(user: user_dependency, db: db_dependency, clinic_id: int = Path(gt=0)):
-    clinic_model = db.query(Clinics).filter(Clinics.id == clinic_id).first()
-    if clinic_model is None:
+async def get_clinic_by_id(user: user_dependency, db: read_db_dependency, clinic_id: int = Path(gt=0)):
+    clinic_row = db.execute(select(Clinics.__table__).where(Clinics.id == clinic_id)).mappings().first()
+    if clinic_row is None:
         raise HTTPException(status_code=404, detail="Clinic not found")
     
-    clinic_pictures = db.query(ClinicPictures).filter(ClinicPictures.clinic_id == clinic_model.id).all()
-    clinic_urls = [f"http://127.0.0.1:8000/picture/clinic_images/{image.image_url}" for image in clinic_pictures]
+    clinic_pictures = db.execute(select(ClinicPictures.image_url).where(ClinicPictures.clinic_id == clinic_id)).scalars()
+    clinic_urls = [f"http://127.0.0.1:8000/picture/clinic_images/{image_url}" for image_url in clinic_pictures]
     
     return {
-        "clinic": clinic_model,
+        "clinic": dict(clinic_row),
         "images": clinic_urls
     }
 
@@ -140,7 +158,7 @@ async def edit_clinic(user: user_dependency, db: db_dependency, clinic_request:
     clinic_model.clinic_speciality = clinic_request.clinic_speciality
     clinic_model.clinic_sub_speciality = clinic_request.clinic_sub_speciality
     clinic_model.staff_type = clinic_request.staff_type
-    db.add(clinic_model)
+    bump_clinic_version(db, clinic_model)
     db.commit()
 
 @router.delete("/delete/{clinic_id}", status_code=status.HTTP_204_NO_CONTENT)
@@ -151,5 +169,51 @@ async def delete_clinic(user: user_dependency, db: db_dependency, clinic_id: int
     if clinic_model.owner_id != user.get("id"):
         raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Unauthorised User")
     
+    db.merge(ClinicTombstones(
+        clinic_id=clinic_model.id,
+        version=next_clinic_version(db),
+        deleted_at=str(datetime.now())
+    ))
     db.delete(clinic_model)
     db.commit()
+
+
+@router.get("/changes", status_code=status.HTTP_200_OK)
+async def get_clinic_changes(
+    user: user_dependency,
+    db: read_db_dependency,
+    since: int = Query(0, ge=0),
+    limit: int = Query(100, gt=0, le=MAX_CHANGES_PAGE_SIZE)):
+
+    # Merge changed clinics and tombstones into a single stream ordered by version
+    changed = union_all(
+        select(Clinics.id.label("clinic_id"), Clinics.version, false().label("deleted")).where(Clinics.version > since),
+        select(ClinicTombstones.clinic_id, ClinicTombstones.version, true().label("deleted")).where(ClinicTombstones.version > since),
+    ).subquery()
+    rows = db.execute(select(changed).order_by(changed.c.version).limit(limit + 1)).all()
+
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+
+    changed_ids = [row.clinic_id for row in rows if not row.deleted]
+
+    clinic_urls = {}
+    clinics = []
+    if changed_ids:
+        picture_rows = db.execute(
+            select(ClinicPictures.clinic_id, ClinicPictures.image_url).where(ClinicPictures.clinic_id.in_(changed_ids))
+        )
+        for clinic_id, image_url in picture_rows:
+            clinic_urls.setdefault(clinic_id, []).append(f"http://127.0.0.1:8000/picture/clinic_images/{image_url}")
+
+        clinic_rows = db.execute(
+            select(Clinics.__table__).where(Clinics.id.in_(changed_ids)).order_by(Clinics.version)
+        ).mappings()
+        clinics = [{"clinic": dict(clinic), "images": clinic_urls.get(clinic["id"], [])} for clinic in clinic_rows]
+
+    return {
+        "clinics": clinics,
+        "deleted": [row.clinic_id for row in rows if row.deleted],
+        "cursor": rows[-1].version if rows else since,
+        "has_more": has_more
+    }
@@ -1,70 +1,43 @@
 from typing import Annotated
 from fastapi import APIRouter, UploadFile, File, HTTPException, Depends, Form
-from fastapi.responses import FileResponse
-import os
-from database import SessionLocal
+from fastapi.concurrency import run_in_threadpool
+from database import get_db
 from sqlalchemy.orm import Session
-from routers.auth import get_current_user
+from routers.auth import get_current_user, get_current_user_model, invalidate_cached_user
+from routers.clinics import bump_clinic_version
 from models import Clinics, Users, ProfilePictures, ClinicPictures
+from storage import storage, CLINIC_PICTURES, PROFILE_PICTURES, USERS_IDS
 import uuid
 from typing import List
 
 
 
-def get_db():
-    db = SessionLocal()
-    try:
-        yield db
-    finally:
-        db.close()
-
 db_dependency = Annotated[Session, Depends(get_db)]
 user_dependency = Annotated[dict, Depends(get_current_user)]
+current_user_dependency = Annotated[Users, Depends(get_current_user_model)]
 
-async def save_image(image: UploadFile):
+async def save_image(image: UploadFile, category: str = CLINIC_PICTURES):
     if not image.content_type.startswith('image/'):
         raise HTTPException(status_code=400, detail="The uploaded file is not an image")
     
-    file_extension = image.filename.split('.')[-1]
+    # Only keep the characters of the extension that are safe in a storage key
+    file_extension = "".join(c for c in image.filename.split('.')[-1] if c.isalnum()) or "img"
     unique_filename = f"{uuid.uuid4().hex}.{file_extension}"
-    
-    directory = "images/clinic_pictures"
-    if not os.path.exists(directory):
-        os.makedirs(directory)
 
-    save_path = os.path.join(directory, unique_filename)
-    with open(save_path, "wb") as f:
-        f.write(await image.read())
+    # Storage backends do blocking I/O and may wait on locks, keep them off the event loop
+    await run_in_threadpool(storage.save, category, unique_filename, await image.read())
 
     return unique_filename
 
 router = APIRouter(prefix="/picture", tags=['picture'])
 
 @router.post("/upload_profile_picture")
-async def upload_profile_picture(db: db_dependency, user: user_dependency, profile_picture: UploadFile = File(...)):
-
-    user_model = db.query(Users).filter(Users.id == user.get("id")).first()
-
-    if user_model is None:
-        raise HTTPException(status_code=404, detail="User not found")
+async def upload_profile_picture(db: db_dependency, user_model: current_user_dependency, profile_picture: UploadFile = File(...)):
 
-    # Check the file type
-    if not profile_picture.content_type.startswith('image/'):
-        raise HTTPException(status_code=400, detail="The uploaded file is not an image")
-    
-    file_extension = profile_picture.filename.split('.')[-1]
-    unique_filename = f"{uuid.uuid4().hex}.{file_extension}"
+    unique_filename = await save_image(profile_picture, PROFILE_PICTURES)
     
-    # Define the path to save the image
-    directory = "images/profile_pictures"
-    if not os.path.exists(directory):
-        os.makedirs(directory)
-
-    save_path = os.path.join(directory, unique_filename)
-    with open(save_path, "wb") as f:
-        f.write(await profile_picture.read())
-    
-    picture_model = db.query(ProfilePictures).filter(ProfilePictures.user_id == user.get("id")).first()
+    user_id = user_model.id
+    picture_model = user_model.profile_picture[0] if user_model.profile_picture else None
 
     if picture_model is None:
 
@@ -75,24 +48,24 @@ async def upload_profile_picture(db: db_dependency, user: user_dependency, profi
         db.add(picture_model)
         db.commit()
     else:
-        os.remove(f"images/profile_pictures/{picture_model.image_url}")
+        await run_in_threadpool(storage.delete, PROFILE_PICTURES, picture_model.image_url)
         picture_model.user_id = user_model.id
         picture_model.image_url = unique_filename
         db.add(picture_model)
         db.commit()
+    invalidate_cached_user(user_id)
     
 
     return {"message": "Image uploaded successfuly"}
 
 @router.get("/profile_image/{filename}", status_code=200)
 async def get_user_image(filename: str):
-    directory = "images/profile_pictures"
-    file_path = os.path.join(directory, filename)
+    response = await run_in_threadpool(storage.response, PROFILE_PICTURES, filename)
 
-    if not os.path.isfile(file_path):
+    if response is None:
         raise HTTPException(status_code=404, detail="Image not found")
 
-    return FileResponse(file_path)
+    return response
 
 @router.delete("/profile_picture/{id}")
 async def delete_profile_picture(user: user_dependency,db: db_dependency, id: int):
@@ -101,26 +74,31 @@ async def delete_profile_picture(user: user_dependency,db: db_dependency, id: in
     if picture_model is None:
         raise HTTPException(status_code=404, detail="Image not found")
     
+    user_id = picture_model.user_id
     db.delete(picture_model)
     db.commit()
+    invalidate_cached_user(user_id)
 
     return {"message": "Image deleted successfully"}
 
 
 
 @router.post("/add_clinic_pictures")
-async def add_clinic_pictures(db: db_dependency, user: user_dependency ,clinic_id: int = Form(...), images: List[UploadFile] = File(...)):
+async def add_clinic_pictures(db: db_dependency, user_model: current_user_dependency, clinic_id: int = Form(...), images: List[UploadFile] = File(...)):
 
     clinic_model = db.query(Clinics).filter(Clinics.id == clinic_id).first()
-    user_model = db.query(Users).filter(Users.id == user.get("id")).first()
-    if not clinic_model or not user_model:
+    if not clinic_model:
         raise HTTPException(status_code=404, detail="Clinic not found")
     
     if not user_model.id == clinic_model.owner_id:
         raise HTTPException(status_code=401, detail="it's not your clinic bro")
     
-    for image in images:
-        file_name = await save_image(image)
+    file_names = [await save_image(image) for image in images]
+
+    # Bumping the version takes the database write lock, so only do it once
+    # the uploads are stored and nothing is awaited before the commit
+    bump_clinic_version(db, clinic_model)
+    for file_name in file_names:
         picture = ClinicPictures(
             clinic_id = clinic_id,
             image_url = file_name 
@@ -133,13 +111,12 @@ async def add_clinic_pictures(db: db_dependency, user: user_dependency ,clinic_i
 
 @router.get("/clinic_images/{filename}", status_code=200)
 async def display_clinic_image(filename: str):
-    directory = "images/clinic_pictures"
-    file_path = os.path.join(directory, filename)
+    response = await run_in_threadpool(storage.response, CLINIC_PICTURES, filename)
 
-    if not os.path.isfile(file_path):
+    if response is None:
         raise HTTPException(status_code=404, detail="Image not found")
 
-    return FileResponse(file_path)
+    return response
 
 @router.delete("/clinic_picture/{id}")
 async def delete_profile_picture(user: user_dependency,db: db_dependency, id: int):
@@ -155,6 +132,7 @@ async def delete_profile_picture(user: user_dependency,db: db_dependency, id: in
     if picture_model.clinic_id != clinic_model.id:
         raise HTTPException(status_code=404, detail="This picture is not associated with this clinic")
     
+    bump_clinic_version(db, clinic_model)
     db.delete(picture_model)
     db.commit()
 
@@ -162,18 +140,5 @@ async def delete_profile_picture(user: user_dependency,db: db_dependency, id: in
 
 @router.post("/test/doctor_id")
 async def upload_id_picture(db: db_dependency, user_id: UploadFile = File(...)):
-    # Check the file type
-    if not user_id.content_type.startswith('image/'):
-        raise HTTPException(status_code=400, detail="The uploaded file is not an image")
-    
-    file_extension = user_id.filename.split('.')[-1]
-    unique_filename = f"{uuid.uuid4().hex}.{file_extension}"
-
-    directory = "images/users_ids"
-    if not os.path.exists(directory):
-        os.makedirs(directory)
-
-    save_path = os.path.join(directory, unique_filename)
-    with open(save_path, "wb") as f:
-        f.write(await user_id.read())
+    await save_image(user_id, USERS_IDS)
 
@@ -1,22 +1,19 @@
 from typing import Annotated
 from fastapi import APIRouter, Depends, HTTPException
 from pydantic import BaseModel
-from database import SessionLocal
-from routers.auth import get_current_user
+from database import get_db, get_read_db
+from routers.auth import get_current_user, get_current_user_model, invalidate_cached_user
+from routers.clinics import bump_clinic_version
 from passlib.context import CryptContext
+from sqlalchemy import Connection, select
 from sqlalchemy.orm import Session
 from models import Users, ProfilePictures
 from starlette import status
 
-def get_db():
-    db = SessionLocal()
-    try:
-        yield db
-    finally:
-        db.close()
-
 db_dependency = Annotated[Session, Depends(get_db)]
+read_db_dependency = Annotated[Connection, Depends(get_read_db)]
 user_dependency = Annotated[dict, Depends(get_current_user)]
+current_user_dependency = Annotated[Users, Depends(get_current_user_model)]
 bcrypt_context = CryptContext(schemes=['bcrypt'], deprecated='auto')
 
 
@@ -56,16 +53,10 @@ class UpdateUserRequest(BaseModel):
 
 # API endpoint to return the current user information
 @router.get("/get_user_information", status_code=status.HTTP_200_OK)
-async def get_user_information(user: user_dependency, db: db_dependency):
-    if user is None:
-        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED)
-    
-    user_model = db.query(Users).filter(Users.id == user.get("id")).first()
-    picture_model = db.query(ProfilePictures).filter(ProfilePictures.user_id == user.get("id")).first()
-
+async def get_user_information(user_model: current_user_dependency):
     profile_picture = ""
-    if picture_model is not None:
-        profile_picture = f"http://127.0.0.1:8000/picture/profile_image/{picture_model.image_url}"
+    if user_model.profile_picture:
+        profile_picture = f"http://127.0.0.1:8000/picture/profile_image/{user_model.profile_picture[0].image_url}"
 
     return_message = {
         "id": user_model.id,
@@ -82,15 +73,8 @@ async def get_user_information(user: user_dependency, db: db_dependency):
 
 # API endpoint to change user's password
 @router.put("/change/password", status_code=status.HTTP_204_NO_CONTENT)
-async def change_password(user: user_dependency, db: db_dependency, change_password_request: ChangePasswordRequest):
+async def change_password(user_model: current_user_dependency, db: db_dependency, change_password_request: ChangePasswordRequest):
 
-    user_model = db.query(Users).filter(Users.id == user.get("id")).first()
-    if user_model.id != user.get("id"):
-        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Unauthorised User")
-    
-    if user_model is None:
-        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="User is not found")
-    
     if change_password_request.new_password != change_password_request.repeated_password:
         raise HTTPException(status_code=400, detail="Password Doesn't match")
     
@@ -99,28 +83,31 @@ async def change_password(user: user_dependency, db: db_dependency, change_passw
         user_model.hashed_password = bcrypt_context.hash(change_password_request.new_password)
         db.add(user_model)
         db.commit()
+        invalidate_cached_user(user_model.id)
     else:
         raise HTTPException(status_code=400, detail="Old password doesn't match the password in database")
     
 @router.get("/{user_id}", status_code=status.HTTP_200_OK)
-async def get_user_by_id(db: db_dependency, user:user_dependency, user_id: int):
+async def get_user_by_id(db: read_db_dependency, user:user_dependency, user_id: int):
 
-    user_model = db.query(Users).filter(Users.id == user_id).first()
-    picture_model = db.query(ProfilePictures).filter(ProfilePictures.user_id == user_id).first()
+    user_row = db.execute(
+        select(Users.full_name, Users.date_of_birth, Users.mobile_number, Users.doctor_speciality, ProfilePictures.image_url)
+        .outerjoin(ProfilePictures, ProfilePictures.user_id == Users.id)
+        .where(Users.id == user_id)
+    ).first()
 
-    if user_model is None:
+    if user_row is None:
         raise HTTPException(status_code=404, detail="User not found")
     
     profile_picture = ""
-    if picture_model is not None:
-        profile_picture = f"http://127.0.0.1:8000/picture/profile_image/{picture_model.image_url}"
+    if user_row.image_url is not None:
+        profile_picture = f"http://127.0.0.1:8000/picture/profile_image/{user_row.image_url}"
     
     user_details = {
-        "full_name": user_model.full_name,
-        "date_of_birth": user_model.date_of_birth,
-        "profile_picture": user_model.profile_picture,
-        "mobile_number": user_model.mobile_number,
-        "doctor_speciality": user_model.doctor_speciality,
+        "full_name": user_row.full_name,
+        "date_of_birth": user_row.date_of_birth,
+        "mobile_number": user_row.mobile_number,
+        "doctor_speciality": user_row.doctor_speciality,
         "profile_picture": profile_picture
     }
     return user_details
@@ -141,11 +128,12 @@ async def get_user_by_id(db: db_dependency, user:user_dependency, user_id: int):
 
 
 @router.delete("/user_delete")
-async def delete_user(db: db_dependency, user: user_dependency):
-    user_model = db.query(Users).filter(Users.id == user.get("id")).first()
-
-    if user_model is None:
-        raise HTTPException(status_code=404, detail="User's data doesn't exist")
+async def delete_user(db: db_dependency, user_model: current_user_dependency):
+    user_id = user_model.id
+    # Deleting the user clears owner_id on their clinics, let synced clients know
+    for clinic_model in user_model.clinics:
+        bump_clinic_version(db, clinic_model)
     db.delete(user_model)
     db.commit()
+    invalidate_cached_user(user_id)
     return {"message": "user deleted succefully"}
\ No newline at end of file
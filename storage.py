@@ -0,0 +1,438 @@
+import mimetypes
+from abc import ABC, abstractmethod
+import mmap
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+from fastapi.responses import FileResponse, Response, StreamingResponse
+
+# Image categories, one per kind of uploaded picture
+CLINIC_PICTURES = "clinic_pictures"
+PROFILE_PICTURES = "profile_pictures"
+USERS_IDS = "users_ids"
+
+# Storage configuration, "local", "packed" or "s3"
+IMAGE_STORAGE_BACKEND = os.getenv("IMAGE_STORAGE_BACKEND", "local")
+IMAGE_STORAGE_ROOT = os.getenv("IMAGE_STORAGE_ROOT", "images")
+PACKED_SEGMENT_SIZE = int(os.getenv("PACKED_SEGMENT_SIZE", str(256 * 1024 * 1024)))
+# Fraction of a sealed segment that must be deleted images before it is compacted
+PACKED_COMPACT_RATIO = float(os.getenv("PACKED_COMPACT_RATIO", "0.5"))
+S3_BUCKET = os.getenv("S3_BUCKET", "clinicconnect-images")
+S3_ENDPOINT_URL = os.getenv("S3_ENDPOINT_URL")  # e.g. a local MinIO instance
+
+
+def _is_valid_key(key: str):
+    # Keys come straight from the URL, never let them escape the category. The
+    # packed index is space separated, so whitespace is rejected as well.
+    return (
+        bool(key) and key not in (".", "..") and os.path.basename(key) == key
+        and not any(c.isspace() for c in key)
+    )
+
+
+def _check_key(key: str):
+    if not _is_valid_key(key):
+        raise ValueError(f"Invalid image key: {key!r}")
+
+
+def _media_type(key: str):
+    return mimetypes.guess_type(key)[0] or "application/octet-stream"
+
+
+class StorageBackend(ABC):
+    """Interface shared by every image storage backend.
+
+    Images are addressed by a category and a key, the key being the value
+    stored in the ``image_url`` columns.
+    """
+
+    @abstractmethod
+    def save(self, category: str, key: str, data: bytes):
+        """Store an image under a key."""
+
+    @abstractmethod
+    def delete(self, category: str, key: str):
+        """Remove an image, returning the number of bytes freed."""
+
+    @abstractmethod
+    def response(self, category: str, key: str):
+        """Return a response serving the image, or None when it doesn't exist."""
+
+    @abstractmethod
+    def list_images(self, category: str):
+        """Yield ``(key, size, mtime)`` for every stored image in a category."""
+
+    def compact(self, category: str):
+        """Give space held by deleted images back to the filesystem."""
+        return 0
+
+
+class LocalStorage(StorageBackend):
+    """One file per image, spread over two levels of subdirectories.
+
+    ``abcdef...jpg`` is stored at ``<root>/<category>/ab/cd/abcdef...jpg`` so
+    no single directory grows past a few thousand entries. Files written
+    before sharding was introduced are still found at ``<root>/<category>/<key>``.
+    """
+
+    def __init__(self, root: str):
+        self.root = root
+
+    def _path(self, category: str, key: str):
+        return os.path.join(self.root, category, key[:2], key[2:4], key)
+
+    def _find(self, category: str, key: str):
+        if not _is_valid_key(key):
+            return None
+        for path in (self._path(category, key), os.path.join(self.root, category, key)):
+            if os.path.isfile(path):
+                return path
+        return None
+
+    def save(self, category: str, key: str, data: bytes):
+        _check_key(key)
+        path = self._path(category, key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "wb") as f:
+            f.write(data)
+
+    def delete(self, category: str, key: str):
+        path = self._find(category, key)
+        if path is None:
+            return 0
+        size = os.path.getsize(path)
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            return 0
+        return size
+
+    def response(self, category: str, key: str):
+        path = self._find(category, key)
+        if path is None:
+            return None
+        return FileResponse(path)
+
+    def list_images(self, category: str):
+        directory = os.path.join(self.root, category)
+        for dirpath, _, filenames in os.walk(directory):
+            for name in filenames:
+                try:
+                    stat = os.stat(os.path.join(dirpath, name))
+                except FileNotFoundError:
+                    continue
+                yield name, stat.st_size, stat.st_mtime
+
+
+class _PackedCategory:
+    """Segment files and offset index of a single category.
+
+    ``index.log`` is the shared source of truth: every process re-reads the
+    lines appended since its last look before each access, and reloads the
+    whole file when compaction has replaced it. Writes, deletes and compaction
+    hold an ``flock`` on ``lock`` so several workers and the GC CLI can share
+    a store. The highest segment is the one appended to and is never
+    compacted, so segment numbers are never reused.
+    """
+
+    def __init__(self, directory: str, segment_size: int, compact_ratio: float):
+        self.directory = directory
+        self.segment_size = segment_size
+        self.compact_ratio = compact_ratio
+        self.index_path = os.path.join(directory, "index.log")
+        self.lock_path = os.path.join(directory, "lock")
+        # key -> (segment, offset, length, mtime)
+        self.index = {}
+        self.maps = {}
+        # Identity of the index file read so far and how far into it
+        self.index_inode = None
+        self.index_position = 0
+        # Guards the in-memory state only, never held during disk copies
+        self.lock = threading.Lock()
+
+        os.makedirs(directory, exist_ok=True)
+
+    @contextmanager
+    def _exclusive(self):
+        # A fresh descriptor per acquisition, so the lock also excludes other threads
+        with open(self.lock_path, "a") as f:
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+
+    def _segments(self):
+        return sorted(
+            int(name[len("segment-"):-len(".dat")])
+            for name in os.listdir(self.directory)
+            if name.startswith("segment-") and name.endswith(".dat")
+        )
+
+    def segment_path(self, segment: int):
+        return os.path.join(self.directory, f"segment-{segment:05d}.dat")
+
+    def _apply(self, line: str):
+        fields = line.split()
+        if len(fields) == 2 and fields[1] == "-":
+            self.index.pop(fields[0], None)
+        elif len(fields) == 5:
+            key, segment, offset, length, mtime = fields
+            self.index[key] = (int(segment), int(offset), int(length), float(mtime))
+
+    def refresh(self):
+        """Pick up index changes made by this or any other process."""
+        try:
+            f = open(self.index_path, "rb")
+        except FileNotFoundError:
+            return
+        with f:
+            inode = os.fstat(f.fileno()).st_ino
+            with self.lock:
+                if inode != self.index_inode:
+                    # Compaction swapped the index, start over and drop stale maps
+                    self.index = {}
+                    self.index_inode = inode
+                    self.index_position = 0
+                    for current in self.maps.values():
+                        current.close()
+                    self.maps = {}
+                f.seek(self.index_position)
+                chunk = f.read()
+                # Leave a line that is still being written for the next refresh
+                complete = chunk[:chunk.rfind(b"\n") + 1]
+                for line in complete.decode().splitlines():
+                    self._apply(line)
+                self.index_position += len(complete)
+
+    def _append_index(self, line: str):
+        with open(self.index_path, "a") as f:
+            f.write(line + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+
+    def _append_blob(self, data: bytes, min_segment: int = 1):
+        segments = self._segments()
+        segment = max(segments[-1] if segments else 1, min_segment)
+        path = self.segment_path(segment)
+        if os.path.exists(path) and os.path.getsize(path) + len(data) > self.segment_size:
+            segment += 1
+            path = self.segment_path(segment)
+        with open(path, "ab") as f:
+            offset = f.tell()
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        return segment, offset
+
+    def _map(self, segment: int, end: int):
+        # Segments only grow, remap when a read goes past the mapped length
+        current = self.maps.get(segment)
+        if current is None or len(current) < end:
+            with open(self.segment_path(segment), "rb") as f:
+                new_map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            if current is not None:
+                current.close()
+            self.maps[segment] = current = new_map
+        return current
+
+    def _read_entry(self, key: str):
+        with self.lock:
+            entry = self.index.get(key)
+            if entry is None:
+                return None
+            segment, offset, length, _ = entry
+            return bytes(self._map(segment, offset + length)[offset:offset + length])
+
+    def read(self, key: str):
+        self.refresh()
+        try:
+            return self._read_entry(key)
+        except FileNotFoundError:
+            # The segment was compacted away since the refresh, the index has moved on
+            self.refresh()
+            return self._read_entry(key)
+
+    def entries(self):
+        self.refresh()
+        with self.lock:
+            return list(self.index.items())
+
+    def write(self, key: str, data: bytes):
+        with self._exclusive():
+            segment, offset = self._append_blob(data)
+            self._append_index(f"{key} {segment} {offset} {len(data)} {time.time()}")
+        self.refresh()
+
+    def remove(self, key: str):
+        with self._exclusive():
+            self.refresh()
+            entry = self.index.get(key)
+            if entry is None:
+                return 0
+            self._append_index(f"{key} -")
+        self.refresh()
+        return entry[2]
+
+    def compact(self):
+        # Copy the live blobs of sealed segments that are mostly dead into new
+        # segments, swap in a rewritten index and drop the old segment files.
+        with self._exclusive():
+            self.refresh()
+            segments = self._segments()
+            if len(segments) < 2:
+                return 0
+            sealed = segments[:-1]
+
+            index = dict(self.entries())
+            live_bytes = {segment: 0 for segment in segments}
+            for segment, _, length, _ in index.values():
+                live_bytes[segment] = live_bytes.get(segment, 0) + length
+            sizes = {segment: os.path.getsize(self.segment_path(segment)) for segment in sealed}
+            dead = [
+                segment for segment in sealed
+                if sizes[segment] and (sizes[segment] - live_bytes[segment]) / sizes[segment] >= self.compact_ratio
+            ]
+            if not dead:
+                return 0
+
+            # Readers keep serving the old locations while blobs are copied
+            for key, (segment, offset, length, mtime) in index.items():
+                if segment not in dead:
+                    continue
+                with open(self.segment_path(segment), "rb") as f:
+                    f.seek(offset)
+                    data = f.read(length)
+                new_segment, new_offset = self._append_blob(data, min_segment=segments[-1] + 1)
+                index[key] = (new_segment, new_offset, length, mtime)
+
+            tmp_path = self.index_path + ".tmp"
+            with open(tmp_path, "w") as f:
+                for key, (segment, offset, length, mtime) in index.items():
+                    f.write(f"{key} {segment} {offset} {length} {mtime}\n")
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, self.index_path)
+            self.refresh()
+
+            reclaimed = 0
+            for segment in dead:
+                os.remove(self.segment_path(segment))
+                reclaimed += sizes[segment] - live_bytes[segment]
+            return reclaimed
+
+
+class PackedStorage(StorageBackend):
+    """Images appended to large segment files, located through an offset index.
+
+    Every category keeps ``segment-NNNNN.dat`` files and an append-only
+    ``index.log`` mapping each key to ``(segment, offset, length)``. Reads go
+    through an mmap of the segment, deletes append a tombstone to the index
+    and ``compact`` gives the space back once a segment is mostly dead. Safe
+    to share between processes on the same host (POSIX only).
+    """
+
+    def __init__(self, root: str, segment_size: int = PACKED_SEGMENT_SIZE, compact_ratio: float = PACKED_COMPACT_RATIO):
+        if fcntl is None:
+            raise RuntimeError("The packed image storage backend requires fcntl (POSIX)")
+        self.root = root
+        self.segment_size = segment_size
+        self.compact_ratio = compact_ratio
+        self.categories = {}
+        self.lock = threading.Lock()
+
+    def _category(self, category: str):
+        with self.lock:
+            packed = self.categories.get(category)
+            if packed is None:
+                packed = _PackedCategory(os.path.join(self.root, category), self.segment_size, self.compact_ratio)
+                self.categories[category] = packed
+            return packed
+
+    def save(self, category: str, key: str, data: bytes):
+        _check_key(key)
+        self._category(category).write(key, data)
+
+    def delete(self, category: str, key: str):
+        return self._category(category).remove(key)
+
+    def response(self, category: str, key: str):
+        if not _is_valid_key(key):
+            return None
+        data = self._category(category).read(key)
+        if data is None:
+            return None
+        return Response(content=data, media_type=_media_type(key))
+
+    def list_images(self, category: str):
+        for key, (_, _, length, mtime) in self._category(category).entries():
+            yield key, length, mtime
+
+    def compact(self, category: str):
+        return self._category(category).compact()
+
+
+class S3Storage(StorageBackend):
+    """Images stored as ``<category>/<key>`` objects in an S3-compatible bucket.
+
+    Point ``S3_ENDPOINT_URL`` at a local MinIO (or any S3 stand-in) to move
+    images off the API node's disk. Requires ``boto3``.
+    """
+
+    def __init__(self, bucket: str, endpoint_url: str = None):
+        try:
+            import boto3
+            from botocore.exceptions import ClientError
+        except ImportError:
+            raise RuntimeError("The s3 image storage backend requires boto3 to be installed")
+        self.bucket = bucket
+        self.client = boto3.client("s3", endpoint_url=endpoint_url)
+        self.client_error = ClientError
+
+    def save(self, category: str, key: str, data: bytes):
+        _check_key(key)
+        self.client.put_object(Bucket=self.bucket, Key=f"{category}/{key}", Body=data, ContentType=_media_type(key))
+
+    def delete(self, category: str, key: str):
+        try:
+            head = self.client.head_object(Bucket=self.bucket, Key=f"{category}/{key}")
+        except self.client_error:
+            return 0
+        self.client.delete_object(Bucket=self.bucket, Key=f"{category}/{key}")
+        return head["ContentLength"]
+
+    def response(self, category: str, key: str):
+        if not _is_valid_key(key):
+            return None
+        try:
+            obj = self.client.get_object(Bucket=self.bucket, Key=f"{category}/{key}")
+        except self.client_error:
+            return None
+        return StreamingResponse(obj["Body"].iter_chunks(), media_type=obj.get("ContentType") or _media_type(key))
+
+    def list_images(self, category: str):
+        paginator = self.client.get_paginator("list_objects_v2")
+        for page in paginator.paginate(Bucket=self.bucket, Prefix=f"{category}/"):
+            for obj in page.get("Contents", []):
+                yield obj["Key"].split("/", 1)[1], obj["Size"], obj["LastModified"].timestamp()
+
+
+def create_storage(backend: str = IMAGE_STORAGE_BACKEND):
+    if backend == "local":
+        return LocalStorage(IMAGE_STORAGE_ROOT)
+    if backend == "packed":
+        return PackedStorage(IMAGE_STORAGE_ROOT)
+    if backend == "s3":
+        return S3Storage(S3_BUCKET, S3_ENDPOINT_URL)
+    raise ValueError(f"Unknown image storage backend: {backend}")
+
+
+# Storage backend shared by the whole application
+storage = create_storage()